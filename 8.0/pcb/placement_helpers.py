@@ -1,33 +1,392 @@
+import csv
+import fnmatch
+import collections
+import functools
+import json
 import math
+import re
 from pcbnew import *
 
 
 """
 import placement_helpers
 placement_helpers.place_circle(placement_helpers.make_references('D', start_number=1, number=60), -90, (140,140), 60, component_offset=-90, hide_ref=True, lock=False)
+placement_helpers.place_circle('D1-D60', -90, (140,140), 60, component_offset=-90)
+placement_helpers.toggle_reference('re:^LED\\d+$, fp:*0805* & layer:B.Cu', True)
 """
 
+def natural_key(reference):
+    """
+    Sort key that orders references the way a person would (D2 before D10)
+    """
+    return [int(tok) if tok.isdigit() else tok for tok in re.split(r'(\d+)', reference)]
+
+def footprint_index(pcb=None):
+    """
+    Builds a reference -> footprint lookup in a single pass over the board
+    pcb: Board to scan, defaults to the open board
+    """
+    if pcb is None:
+        pcb = GetBoard()
+    return dict((part.GetReference(), part) for part in pcb.GetFootprints())
+
+## D1-D60, D1..D60 and D1-60 all expand to D1 through D60
+rangeExpression = re.compile(r'^([^\d\s]+)(\d+)\s*(?:-|\.\.)\s*(?:\1)?(\d+)$')
+
+def _layer_matches(part, layer):
+    if layer.lower() in ('front', 'top', 'f'):
+        return not part.IsFlipped()
+    if layer.lower() in ('back', 'bottom', 'b'):
+        return part.IsFlipped()
+    return fnmatch.fnmatchcase(part.GetLayerName(), layer)
+
+## What a single reference written out in a selector can look like
+literalReference = re.compile(r'^[A-Za-z#_][A-Za-z0-9#_.+-]*$')
+
+def _split_top_level(text, separator):
+    ## Splits on separator, except inside brackets, braces, parentheses, quotes or after a backslash, so regexes survive
+    pieces = []
+    current = []
+    depth = 0
+    quote = None
+    escaped = False
+    for c in text:
+        if escaped:
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif quote is not None:
+            if c == quote:
+                quote = None
+        elif c in '"\'':
+            quote = c
+        elif c in '([{':
+            depth += 1
+        elif c in ')]}':
+            depth = max(depth-1, 0)
+        elif c == separator and depth == 0:
+            pieces.append(''.join(current))
+            current = []
+            continue
+        current.append(c)
+    pieces.append(''.join(current))
+    return pieces
+
+def _unquote(text):
+    text = text.strip()
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in '"\'':
+        return text[1:-1]
+    return text
+
+## Filters usable as "name:argument" in a selector, each gets the footprint and the argument
+selectorFilters = {
+    'fp':     lambda part, arg: fnmatch.fnmatchcase(str(part.GetFPID().GetLibItemName()), arg),
+    'value':  lambda part, arg: fnmatch.fnmatchcase(part.GetValue(), arg),
+    'layer':  _layer_matches,
+    'sheet':  lambda part, arg: fnmatch.fnmatchcase(part.GetSheetname(), arg) or fnmatch.fnmatchcase(part.GetSheetfile(), arg),
+}
+
+class Selector(object):
+    """
+    A lazily resolved set of references, written as a small expression
+    Terms are separated by commas and their results are combined
+    Within a term, '&' requires every part of the term to match
+    Commas and '&' inside brackets, braces or quotes don't split, so re:^D\\d{1,2}$ and re:"a,b" work as written
+      D1-D60, D121..D132   reference ranges, expanded without touching the board
+      D7                   a single reference
+      LED*                 glob over references
+      re:^LED\\d+$         regex over references
+      fp:*0805*            glob over the footprint name
+      value:100n           glob over the value
+      layer:B.Cu           layer name glob, or front/back
+      sheet:/Channel*      glob over the sheet name or sheet file
+      selected             whatever is selected in pcbnew
+    Everything that needs the board is answered from one scan of it, however many terms there are
+    Expressions made only of ranges and single references keep the order they're written in (D5-D1 counts down),
+    anything else comes back naturally sorted
+    """
+    def __init__(self, expression):
+        self.expression = expression
+        self.terms = [self._parse_term(term) for term in _split_top_level(expression, ',') if term.strip() != '']
+
+    def __repr__(self):
+        return 'Selector({!r})'.format(self.expression)
+
+    def _parse_atom(self, atom):
+        ## Returns (references or None, predicate over a footprint)
+        name, sep, arg = atom.partition(':')
+        if sep and name.strip() == 're':
+            pattern = re.compile(_unquote(arg))
+            return None, lambda part: pattern.search(part.GetReference()) is not None
+        if sep and name.strip() in selectorFilters:
+            check, arg = selectorFilters[name.strip()], _unquote(arg)
+            return None, lambda part: check(part, arg)
+        if atom == 'selected':
+            return None, lambda part: part.IsSelected()
+        if sep:
+            raise ValueError('Unknown selector filter "{}" in {!r}'.format(name.strip(), self.expression))
+        ranged = rangeExpression.match(atom)
+        if ranged is not None:
+            prefix, first, last = ranged.group(1), int(ranged.group(2)), int(ranged.group(3))
+            step = 1 if last >= first else -1
+            references = ['{}{}'.format(prefix, num) for num in range(first, last+step, step)]
+            members = set(references)
+            return references, lambda part: part.GetReference() in members
+        if any(c in atom for c in '*?['):
+            return None, lambda part: fnmatch.fnmatchcase(part.GetReference(), atom)
+        if literalReference.match(atom) is None:
+            raise ValueError('Can\'t make sense of "{}" in {!r}'.format(atom, self.expression))
+        return [atom], lambda part: part.GetReference() == atom
+
+    def _parse_term(self, term):
+        atoms = [self._parse_atom(atom.strip()) for atom in _split_top_level(term, '&')]
+        if len(atoms) == 1 and atoms[0][0] is not None:
+            return atoms[0][0], None
+        predicates = [predicate for (references, predicate) in atoms]
+        return None, lambda part: all(predicate(part) for predicate in predicates)
+
+    def needs_board(self):
+        return any(references is None for (references, predicate) in self.terms)
+
+    def resolve(self, index=None):
+        """
+        Resolves the expression into a list of references, in written order for ranges and single references alone,
+        naturally sorted otherwise
+        index: Reference -> footprint lookup from footprint_index, only built here if a term needs it
+        """
+        found = set()
+        written = []
+        predicates = []
+        for references, predicate in self.terms:
+            if references is not None:
+                written.extend(reference for reference in references if reference not in found)
+                found.update(references)
+            else:
+                predicates.append(predicate)
+        if len(predicates) == 0:
+            return written
+        if index is None:
+            index = footprint_index()
+        for reference, part in index.items():
+            if any(predicate(part) for predicate in predicates):
+                found.add(reference)
+        return sorted(found, key=natural_key)
+
+def select(expression):
+    """
+    Builds a Selector from an expression, see Selector for the syntax
+    """
+    return Selector(expression)
+
+def resolve_references(parts, index=None):
+    """
+    Turns whatever a helper was handed into a list of references
+    parts: A list of references, a Selector, a selector expression string, or a predicate over footprints
+    index: Reference -> footprint lookup, used by selectors that need to look at the board
+    """
+    if parts is None:
+        return None
+    if isinstance(parts, str):
+        parts = Selector(parts)
+    if isinstance(parts, Selector):
+        return parts.resolve(index)
+    if callable(parts):
+        if index is None:
+            index = footprint_index()
+        return sorted((reference for reference, part in index.items() if parts(part)), key=natural_key)
+    return list(parts)
+
+def gather_footprints(parts, index=None):
+    """
+    Collects the footprints for parts from a single scan of the board
+    parts: A list of references, a selector, or a predicate over footprints
+    index: Reference -> footprint lookup to reuse, built from the board if None
+    """
+    if index is None:
+        index = footprint_index()
+    found = []
+    for reference in resolve_references(parts, index):
+        part = _lookup(index, reference)
+        if part is not None:
+            found.append(part)
+    return found
+
+def _lookup(index, reference):
+    part = index.get(reference)
+    if part is None:
+        print("Couldn't find {} on the board, skipping it".format(reference))
+    return part
+
+def _side(part):
+    return 'back' if part.IsFlipped() else 'front'
+
+def _same_angle(a, b):
+    return abs((a - b + 180.0) % 360.0 - 180.0) < 1e-6
+
+class PlacementPlan(object):
+    """
+    A record of where a helper puts parts, one row per part:
+      (reference, x_nm, y_nm, orientation, side, ref_visible)
+    orientation (degrees), side ('front' or 'back') and ref_visible are None where the helper leaves them alone
+    Plans can be saved, loaded, compared, and applied to this board or any other
+    """
+    def __init__(self, rows=None):
+        self.rows = [] if rows is None else [tuple(row) for row in rows]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __eq__(self, other):
+        return isinstance(other, PlacementPlan) and self.rows == other.rows
+
+    def __repr__(self):
+        return 'PlacementPlan({} parts)'.format(len(self.rows))
+
+    def add(self, reference, x, y, orientation=None, side=None, ref_visible=None):
+        """
+        Adds a row, x and y in mm
+        """
+        self.rows.append((reference, FromMM(x), FromMM(y), orientation, side, ref_visible))
+
+    def extend(self, other):
+        self.rows.extend(other.rows)
+
+    def references(self):
+        return [row[0] for row in self.rows]
+
+    def to_json(self):
+        ## One row per line, so plans diff nicely under version control
+        return '{"rows": [\n' + ',\n'.join(json.dumps(list(row)) for row in self.rows) + '\n]}\n'
+
+    @classmethod
+    def from_json(cls, text):
+        return cls(json.loads(text)['rows'])
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            f.write(self.to_json())
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_json(f.read())
+
+    def row_matches(self, part, row):
+        (reference, x, y, orientation, side, ref_visible) = row
+        position = part.GetPosition()
+        return (position.x == x and position.y == y
+                and (orientation is None or _same_angle(part.GetOrientationDegrees(), orientation))
+                and (side is None or _side(part) == side)
+                and (ref_visible is None or part.Reference().IsVisible() == ref_visible))
+
+    def diff(self, other=None, index=None):
+        """
+        Returns the rows of this plan that don't match
+        other: Another PlacementPlan, or None to compare against the board
+        index: Reference -> footprint lookup to compare against, built from the board if None
+        """
+        if isinstance(other, PlacementPlan):
+            theirs = dict((row[0], row) for row in other.rows)
+            return [row for row in self.rows if theirs.get(row[0]) != row]
+        if index is None:
+            index = footprint_index()
+        return [row for row in self.rows if row[0] not in index or not self.row_matches(index[row[0]], row)]
+
+    def apply(self, pcb=None, index=None, refresh=True):
+        """
+        Moves the parts on the board to match the plan, only touching the ones that differ
+        pcb: Board to apply to, defaults to the open board
+        index: Reference -> footprint lookup to reuse, built from pcb if None
+        refresh: Redraws the board when done if true and anything changed
+        Returns the number of parts changed
+        """
+        if index is None:
+            index = footprint_index(pcb)
+        changed = 0
+        for (reference, x, y, orientation, side, ref_visible) in self.diff(index=index):
+            part = _lookup(index, reference)
+            if part is None:
+                continue
+            if side is not None and _side(part) != side:
+                part.Flip(part.GetPosition(), False)
+            part.SetPosition(VECTOR2I(x, y))
+            if orientation is not None:
+                part.SetOrientationDegrees(orientation)
+            if ref_visible is not None:
+                part.Reference().SetVisible(ref_visible)
+            changed += 1
+        if refresh and changed > 0:
+            Refresh()
+        return changed
+
+def load_plan(path):
+    return PlacementPlan.load(path)
+
+## Plans already worked out, keyed by the planner's name and arguments, least recently used first
+planCache = collections.OrderedDict()
+## How many plans planCache holds before dropping the least recently used
+planCacheSize = 256
+
+def plan_references(parts):
+    """
+    Turns what a planner was handed into a list of references without looking at the board
+    parts: A list of references, or a selector made only of ranges and single references
+    """
+    if isinstance(parts, str):
+        parts = Selector(parts)
+    if isinstance(parts, Selector):
+        if parts.needs_board():
+            raise ValueError('{!r} needs the board to resolve, planners only take ranges and single references; resolve it with resolve_references first'.format(parts))
+        return parts.resolve()
+    if callable(parts):
+        raise ValueError('Planners can\'t take a predicate, resolve it with resolve_references first')
+    return parts
+
+def memoized_plan(planner):
+    """
+    Caches a planner's plans by its name and arguments; planners must only depend on their arguments, never the board
+    """
+    @functools.wraps(planner)
+    def cached(*args, **kwargs):
+        key = (planner.__name__, repr(args), repr(sorted(kwargs.items())))
+        plan = planCache.get(key)
+        if plan is None:
+            plan = planner(*args, **kwargs)
+            if plan is None:
+                return None
+            planCache[key] = plan
+            while len(planCache) > planCacheSize:
+                planCache.popitem(last=False)
+        else:
+            planCache.move_to_end(key)
+        return PlacementPlan(plan.rows)
+    return cached
+
+def clear_plan_cache():
+    planCache.clear()
+
 def move_modules_relative(references, relative_movement):
-    pcb = GetBoard()
-    for reference in references:
-        part = pcb.FindFootprintByReference(reference)
+    index = footprint_index()
+    plan = PlacementPlan()
+    for reference in resolve_references(references, index):
+        part = _lookup(index, reference)
+        if part is None:
+            continue
         (xPos, yPos) = (ToMM(v) for v in part.GetPosition())
-        part.SetPosition( VECTOR2I(FromMM(xPos+relative_movement[0]), FromMM(yPos+relative_movement[1])) )
-    Refresh()
+        plan.add(reference, xPos+relative_movement[0], yPos+relative_movement[1])
+    plan.apply(index=index)
+    return plan
  
-def place_circle(refdes, start_angle, center, radius, component_offset=0, hide_ref=True, lock=False, reverse_spin=None):
+@memoized_plan
+def plan_circle(refdes, start_angle, center, radius, component_offset=0, hide_ref=True, reverse_spin=None):
     """
-    Places components in a circle
-    refdes: List of component references
-    start_angle: Starting angle
-    center: Tuple of (x, y) mils of circle center
-    radius: Radius of the circle in mils
-    component_offset: Offset in degrees for each component to add to angle
-    hide_ref: Hides the reference if true, leaves it be if None
-    lock: Locks the footprint if true
-    reverse_spin: If true, increments CCW instead of CW
+    Works out where place_circle puts everything, without touching the board
     """
-    pcb = GetBoard()
+    refdes = plan_references(refdes)
+    plan = PlacementPlan()
     deg_per_idx = 360.0 / len(refdes)
     if reverse_spin is None:
         reverse_spin = False
@@ -36,19 +395,40 @@ def place_circle(refdes, start_angle, center, radius, component_offset=0, hide_r
     for idx, rd in enumerate(refdes):
         if rd is None:
           continue
-        part = pcb.FindFootprintByReference(rd)
         angle = (deg_per_idx * idx + start_angle) % 360.0
         print('{0}: {1}'.format(rd, angle))
         xmils = center[0] + math.cos(math.radians(angle)) * radius
         ymils = center[1] + math.sin(math.radians(angle)) * radius
-        part.SetPosition(VECTOR2I(FromMM(xmils), FromMM(ymils)))
-        part.SetOrientationDegrees(-1*(angle+component_offset))
-        if hide_ref is not None:
-            part.Reference().SetVisible(not hide_ref)
-    Refresh()
+        plan.add(rd, xmils, ymils, orientation=-1*(angle+component_offset), ref_visible=None if hide_ref is None else not hide_ref)
+    return plan
     
-def place_concentric_circles(refdes, start_angle, center, component_width, circle_start_radius=3, circle_spacing=3, component_offset=0, hide_ref=True, lock=False):
-    components_left = list(refdes)
+def place_circle(refdes, start_angle, center, radius, component_offset=0, hide_ref=True, lock=False, reverse_spin=None, index=None, refresh=True, apply=True):
+    """
+    Places components in a circle
+    refdes: List of component references, or a selector
+    start_angle: Starting angle
+    center: Tuple of (x, y) mils of circle center
+    radius: Radius of the circle in mils
+    component_offset: Offset in degrees for each component to add to angle
+    hide_ref: Hides the reference if true, leaves it be if None
+    lock: Locks the footprint if true
+    reverse_spin: If true, increments CCW instead of CW
+    index: Reference -> footprint lookup to reuse, built from the board if None
+    refresh: Redraws the board when done if true
+    apply: Only works out the plan, without moving anything, if false
+    Returns the PlacementPlan
+    """
+    if index is None and apply:
+        index = footprint_index()
+    plan = plan_circle(resolve_references(refdes, index), start_angle, center, radius, component_offset=component_offset, hide_ref=hide_ref, reverse_spin=reverse_spin)
+    if apply:
+        plan.apply(index=index, refresh=refresh)
+    return plan
+
+@memoized_plan
+def plan_concentric_circles(refdes, start_angle, center, component_width, circle_start_radius=3, circle_spacing=3, component_offset=0, hide_ref=True):
+    plan = PlacementPlan()
+    components_left = list(plan_references(refdes))
     spacing = circle_spacing
     if spacing is None or spacing < 0:
         spacing = 3
@@ -62,31 +442,47 @@ def place_concentric_circles(refdes, start_angle, center, component_width, circl
             components_in_radius = (2*math.pi*cur_radius) / component_width
         components_in_radius = math.floor(components_in_radius)
         components_to_move, components_left = components_left[:components_in_radius], components_left[components_in_radius:]
-        place_circle(components_to_move, start_angle, center, cur_radius, component_offset=component_offset, hide_ref=hide_ref, lock=lock)
+        plan.extend(plan_circle(components_to_move, start_angle, center, cur_radius, component_offset=component_offset, hide_ref=hide_ref))
         cur_radius += spacing
+    return plan
     
+def place_concentric_circles(refdes, start_angle, center, component_width, circle_start_radius=3, circle_spacing=3, component_offset=0, hide_ref=True, lock=False, apply=True):
+    index = footprint_index() if apply else None
+    plan = plan_concentric_circles(resolve_references(refdes, index), start_angle, center, component_width, circle_start_radius=circle_start_radius, circle_spacing=circle_spacing, component_offset=component_offset, hide_ref=hide_ref)
+    if apply:
+        plan.apply(index=index)
+    return plan
     
-def place_clock(center=(100.0, 100.0), spacing=3.0, radius_start=30.0):
-    minutes = ['D{}'.format(i+1) for i in range(60)]
-    seconds = ['D{}'.format(i+61) for i in range(60)]
-    hours = ['D{}'.format(i+121) for i in range(12)]
-    minute_caps = ['C{}'.format(i+5) for i in range(10)]
-    second_caps = ['C{}'.format(i+15) for i in range(10)]
-    hour_caps = ['C{}'.format(i+25) for i in range(2)]
-    place_circle(second_caps, -90.0, center, radius_start+(spacing*0), component_offset=-90.0)
-    place_circle(seconds, -90.0, center, radius_start+(spacing*1))
-    place_circle(minute_caps, -90.0, center, radius_start+(spacing*2), component_offset=-90.0)
-    place_circle(minutes, -90.0, center, radius_start+(spacing*3))
-    place_circle(hour_caps, -90.0, center, radius_start+(spacing*4), component_offset=-90.0)
-    place_circle(hours, -90.0, center, radius_start+(spacing*5))
+@memoized_plan
+def plan_clock(center=(100.0, 100.0), spacing=3.0, radius_start=30.0):
+    plan = PlacementPlan()
+    plan.extend(plan_circle(resolve_references('C15-C24'), -90.0, center, radius_start+(spacing*0), component_offset=-90.0))
+    plan.extend(plan_circle(resolve_references('D61-D120'), -90.0, center, radius_start+(spacing*1)))
+    plan.extend(plan_circle(resolve_references('C5-C14'), -90.0, center, radius_start+(spacing*2), component_offset=-90.0))
+    plan.extend(plan_circle(resolve_references('D1-D60'), -90.0, center, radius_start+(spacing*3)))
+    plan.extend(plan_circle(resolve_references('C25-C26'), -90.0, center, radius_start+(spacing*4), component_offset=-90.0))
+    plan.extend(plan_circle(resolve_references('D121-D132'), -90.0, center, radius_start+(spacing*5)))
+    return plan
     
-def place_hexclock(center=(100.0, 100.0), spacing= 3.0, radius_start=25.0, start_angle=-90.0):
-    seconds = ['D{}'.format(i+1) for i in range(6)]
-    minutes = ['D{}'.format(i+7) for i in range(6)]
-    hours   = ['D{}'.format(i+13) for i in range(6)]
-    place_circle(seconds, start_angle, center, radius_start-(spacing*1))
-    place_circle(minutes, start_angle, center, radius_start-(spacing*2))
-    place_circle(hours,   start_angle, center, radius_start-(spacing*3))
+def place_clock(center=(100.0, 100.0), spacing=3.0, radius_start=30.0, apply=True):
+    plan = plan_clock(center=center, spacing=spacing, radius_start=radius_start)
+    if apply:
+        plan.apply()
+    return plan
+
+@memoized_plan
+def plan_hexclock(center=(100.0, 100.0), spacing= 3.0, radius_start=25.0, start_angle=-90.0):
+    plan = PlacementPlan()
+    plan.extend(plan_circle(resolve_references('D1-D6'),   start_angle, center, radius_start-(spacing*1)))
+    plan.extend(plan_circle(resolve_references('D7-D12'),  start_angle, center, radius_start-(spacing*2)))
+    plan.extend(plan_circle(resolve_references('D13-D18'), start_angle, center, radius_start-(spacing*3)))
+    return plan
+
+def place_hexclock(center=(100.0, 100.0), spacing= 3.0, radius_start=25.0, start_angle=-90.0, apply=True):
+    plan = plan_hexclock(center=center, spacing=spacing, radius_start=radius_start, start_angle=start_angle)
+    if apply:
+        plan.apply()
+    return plan
     
 sevenSegDiodeLayout = [
   (-1.5,0), (-0.5,0), (0.5,0), (1.5,0),
@@ -108,7 +504,10 @@ sevenSegCapLayout = [
 def make_references(prefix, start_number=1, number=1):
     return ['{}{}'.format(prefix, num+start_number) for num in range(number)]
     
-def place_7_segment(upper_left=(100.0, 100.0), spacing=(2.54, 3.81), diodes=None, capacitors=None, layout=(sevenSegDiodeLayout, sevenSegCapLayout), refresh=True):
+@memoized_plan
+def plan_7_segment(upper_left=(100.0, 100.0), spacing=(2.54, 3.81), diodes=None, capacitors=None, layout=(sevenSegDiodeLayout, sevenSegCapLayout)):
+    diodes = plan_references(diodes)
+    capacitors = plan_references(capacitors)
     if diodes is None or len(diodes) != 20:
         print("Diode list isn't quite right, expecting a list of exactly 20 diode references, got: {}".format(diodes))
         return
@@ -118,17 +517,22 @@ def place_7_segment(upper_left=(100.0, 100.0), spacing=(2.54, 3.81), diodes=None
     dLayout = layout[0]
     cLayout = layout[1]
     
-    pcb = GetBoard()
+    plan = PlacementPlan()
     for i in range(len(diodes)):
-        part = pcb.FindFootprintByReference(diodes[i])
         offset = dLayout[i]
-        part.SetPosition(VECTOR2I( FromMM(float(upper_left[0])+(float(offset[0])*float(spacing[0]))), FromMM(float(upper_left[1])+(float(offset[1])*float(spacing[1]))) ))
+        plan.add(diodes[i], float(upper_left[0])+(float(offset[0])*float(spacing[0])), float(upper_left[1])+(float(offset[1])*float(spacing[1])))
     for i in range(len(capacitors)):
-        part = pcb.FindFootprintByReference(capacitors[i])
         offset = cLayout[i]
-        part.SetPosition(VECTOR2I( FromMM(float(upper_left[0])+(float(offset[0])*float(spacing[0]))), FromMM(float(upper_left[1])+(float(offset[1])*float(spacing[1]))) ))
-    if refresh:
-        Refresh()
+        plan.add(capacitors[i], float(upper_left[0])+(float(offset[0])*float(spacing[0])), float(upper_left[1])+(float(offset[1])*float(spacing[1])))
+    return plan
+
+def place_7_segment(upper_left=(100.0, 100.0), spacing=(2.54, 3.81), diodes=None, capacitors=None, layout=(sevenSegDiodeLayout, sevenSegCapLayout), refresh=True, index=None, apply=True):
+    if index is None and apply:
+        index = footprint_index()
+    plan = plan_7_segment(upper_left=upper_left, spacing=spacing, diodes=resolve_references(diodes, index), capacitors=resolve_references(capacitors, index), layout=layout)
+    if apply and plan is not None:
+        plan.apply(index=index, refresh=refresh)
+    return plan
         
 colonDiodeLayout = [
     (-0.5,0), (0.5,0),
@@ -142,7 +546,10 @@ colonCapLayout = [
     (0, 0.5)
 ]
         
-def place_colon(upper_left=(100.0, 100.0), spacing=(2.54, 3.81), diodes=None, capacitors=None, layout=(colonDiodeLayout, colonCapLayout), refresh=True):
+@memoized_plan
+def plan_colon(upper_left=(100.0, 100.0), spacing=(2.54, 3.81), diodes=None, capacitors=None, layout=(colonDiodeLayout, colonCapLayout)):
+    diodes = plan_references(diodes)
+    capacitors = plan_references(capacitors)
     if diodes is None or len(diodes) != 8:
         print("Diode list isn't quite right, expecting a list of exactly 8 diode references, got: {}".format(diodes))
         return
@@ -159,27 +566,30 @@ def place_colon(upper_left=(100.0, 100.0), spacing=(2.54, 3.81), diodes=None, ca
     cLayout = layout[1]
     
     
-    pcb = GetBoard()
+    plan = PlacementPlan()
     for i in range(4):
-        part = pcb.FindFootprintByReference(diodes[i])
         offset = dLayout[i]
-        part.SetPosition(VECTOR2I( FromMM(float(upper_left[0])+(float(offset[0])*float(minSpacing))), FromMM(float(upper_left[1])+(float(offset[1])*float(minSpacing)) + (float(topHeight))*float(spacing[1])) ))
+        plan.add(diodes[i], float(upper_left[0])+(float(offset[0])*float(minSpacing)), float(upper_left[1])+(float(offset[1])*float(minSpacing)) + (float(topHeight))*float(spacing[1]))
     for i in range(4, 8):
-        part = pcb.FindFootprintByReference(diodes[i])
         offset = dLayout[i]
-        part.SetPosition(VECTOR2I( FromMM(float(upper_left[0])+(float(offset[0])*float(minSpacing))), FromMM(float(upper_left[1])+(float(offset[1])*float(minSpacing)) + (float(bottomHeight))*float(spacing[1])) ))
-    part = pcb.FindFootprintByReference(capacitors[0])
+        plan.add(diodes[i], float(upper_left[0])+(float(offset[0])*float(minSpacing)), float(upper_left[1])+(float(offset[1])*float(minSpacing)) + (float(bottomHeight))*float(spacing[1]))
     offset = cLayout[0]
-    part.SetPosition(VECTOR2I( FromMM(float(upper_left[0])+(float(offset[0])*float(minSpacing))), FromMM(float(upper_left[1])+(float(offset[1])*float(minSpacing)) + (float(topHeight))*float(spacing[1])) ))
-    part = pcb.FindFootprintByReference(capacitors[1])
+    plan.add(capacitors[0], float(upper_left[0])+(float(offset[0])*float(minSpacing)), float(upper_left[1])+(float(offset[1])*float(minSpacing)) + (float(topHeight))*float(spacing[1]))
     offset = cLayout[1]
-    part.SetPosition(VECTOR2I( FromMM(float(upper_left[0])+(float(offset[0])*float(minSpacing))), FromMM(float(upper_left[1])+(float(offset[1])*float(minSpacing)) + (float(bottomHeight))*float(spacing[1])) ))
+    plan.add(capacitors[1], float(upper_left[0])+(float(offset[0])*float(minSpacing)), float(upper_left[1])+(float(offset[1])*float(minSpacing)) + (float(bottomHeight))*float(spacing[1]))
+    return plan
     
-    if refresh:
-        Refresh()
+def place_colon(upper_left=(100.0, 100.0), spacing=(2.54, 3.81), diodes=None, capacitors=None, layout=(colonDiodeLayout, colonCapLayout), refresh=True, index=None, apply=True):
+    if index is None and apply:
+        index = footprint_index()
+    plan = plan_colon(upper_left=upper_left, spacing=spacing, diodes=resolve_references(diodes, index), capacitors=resolve_references(capacitors, index), layout=layout)
+    if apply and plan is not None:
+        plan.apply(index=index, refresh=refresh)
+    return plan
     
  
-def place_7_segment_clock(upper_left=(100.0, 100.0), spacing=(2.54, 3.81), inter_digit_spacing=15.0, colon_spacing=0.0, diode_starts=(117, 97, 77, 57, 1, 21), capacitor_starts=(35, 30, 25, 20, 6, 11), colon_starts=(49, 41), colon_cap_starts=(18, 16)):
+@memoized_plan
+def plan_7_segment_clock(upper_left=(100.0, 100.0), spacing=(2.54, 3.81), inter_digit_spacing=15.0, colon_spacing=0.0, diode_starts=(117, 97, 77, 57, 1, 21), capacitor_starts=(35, 30, 25, 20, 6, 11), colon_starts=(49, 41), colon_cap_starts=(18, 16)):
     if diode_starts is None or len(diode_starts) != 6:
         print("Diode list isn't quite right, expecting a list of exactly 6 diode reference numbers, got: {}".format(diode_starts))
         return
@@ -192,31 +602,36 @@ def place_7_segment_clock(upper_left=(100.0, 100.0), spacing=(2.54, 3.81), inter
     if colon_cap_starts is None or len(colon_cap_starts) != 2:
         print("Capacitor list for colons isn't quite right, expecting a list of exactly 2 capacitor reference numbers, got: {}".format(colon_cap_starts))
         return
+    plan = PlacementPlan()
     accumulator = 0
     for i in range(6):
         colon_remainder = i%2
-        place_7_segment(
+        plan.extend(plan_7_segment(
                 upper_left=(upper_left[0]+accumulator, upper_left[1]),
                 spacing=spacing,
                 diodes=make_references("D", diode_starts[i], 20),
-                capacitors=make_references("C", capacitor_starts[i], 5),
-                refresh=False
-        )
+                capacitors=make_references("C", capacitor_starts[i], 5)
+        ))
         if colon_remainder == 0:
             accumulator+=float(inter_digit_spacing)
         if colon_remainder == 1:
             accumulator+=float(colon_spacing)*2
     accumulator = float(inter_digit_spacing)+float(colon_spacing)
     for i in range(2):
-        place_colon(
+        plan.extend(plan_colon(
                 upper_left=(upper_left[0]+accumulator, upper_left[1]),
                 spacing=spacing,
                 diodes=make_references("D", colon_starts[i], 8),
-                capacitors=make_references("C", colon_cap_starts[i], 2),
-                refresh=False
-        )
+                capacitors=make_references("C", colon_cap_starts[i], 2)
+        ))
         accumulator+=float(inter_digit_spacing)+float(colon_spacing)*2
-    Refresh()
+    return plan
+
+def place_7_segment_clock(upper_left=(100.0, 100.0), spacing=(2.54, 3.81), inter_digit_spacing=15.0, colon_spacing=0.0, diode_starts=(117, 97, 77, 57, 1, 21), capacitor_starts=(35, 30, 25, 20, 6, 11), colon_starts=(49, 41), colon_cap_starts=(18, 16), apply=True):
+    plan = plan_7_segment_clock(upper_left=upper_left, spacing=spacing, inter_digit_spacing=inter_digit_spacing, colon_spacing=colon_spacing, diode_starts=diode_starts, capacitor_starts=capacitor_starts, colon_starts=colon_starts, colon_cap_starts=colon_cap_starts)
+    if apply and plan is not None:
+        plan.apply()
+    return plan
     
 sevenSegEquidistantDiodeLayout = [
   (-0.5,0),   (0,0), (0.5,0),
@@ -226,54 +641,250 @@ sevenSegEquidistantDiodeLayout = [
   (-0.5,2),   (0,2), (0.5,2)
 ]
     
-def place_7_segment_equidistant(upper_left=(100.0, 100.0), spacing=(2.54, 3.81), diodes=None, layout=None, refresh=True):
+@memoized_plan
+def plan_7_segment_equidistant(upper_left=(100.0, 100.0), spacing=(2.54, 3.81), diodes=None, layout=None):
+    diodes = plan_references(diodes)
     if layout is None:
         layout = sevenSegEquidistantDiodeLayout
     if diodes is None or len(diodes) != len(layout):
         print("Diode list isn't quite right, expecting a list of exactly {} diode references, got: {}".format(len(layout), diodes))
         return
     
-    pcb = GetBoard()
+    plan = PlacementPlan()
     for i in range(len(diodes)):
-        part = pcb.FindFootprintByReference(diodes[i])
         offset = layout[i]
-        part.SetPosition(VECTOR2I( FromMM(float(upper_left[0])+(float(offset[0])*float(spacing[0]))), FromMM(float(upper_left[1])+(float(offset[1])*float(spacing[1]))) ))
-    if refresh:
-        Refresh()
+        plan.add(diodes[i], float(upper_left[0])+(float(offset[0])*float(spacing[0])), float(upper_left[1])+(float(offset[1])*float(spacing[1])))
+    return plan
+
+def place_7_segment_equidistant(upper_left=(100.0, 100.0), spacing=(2.54, 3.81), diodes=None, layout=None, refresh=True, apply=True):
+    index = footprint_index() if apply else None
+    plan = plan_7_segment_equidistant(upper_left=upper_left, spacing=spacing, diodes=resolve_references(diodes, index), layout=layout)
+    if apply and plan is not None:
+        plan.apply(index=index, refresh=refresh)
+    return plan
     
 def toggle_reference(parts, turn_on, turn_value_on=None):
-    pcb = GetBoard()
+    """
+    Shows or hides the reference (and optionally the value) of parts
+    parts: List of references, a selector (e.g. 'selected' or 'fp:LED* & layer:back'), or a predicate over footprints
+    turn_on: Shows the reference if true, hides it if false
+    turn_value_on: Shows or hides the value too, leaves it be if None
+    """
     if turn_on is None:
         turn_on = True
-    for ref in parts:
-        part = pcb.FindFootprintByReference(ref)
-        if part is not None:
-            part.Reference().SetVisible(turn_on)
-            if turn_value_on is not None:
-                part.Value().SetVisible(turn_value_on)
+    for part in gather_footprints(parts):
+        part.Reference().SetVisible(turn_on)
+        if turn_value_on is not None:
+            part.Value().SetVisible(turn_value_on)
     Refresh()
     
-def rotate_parts(parts, angle):
-    pcb = GetBoard()
+def rotate_parts(parts, angle=None):
+    """
+    Turns parts in place
+    parts: List of references, a selector, or a predicate over footprints
+    angle: Degrees to turn each part by, 180 if None
+    """
     if angle is None:
-        angle = 0
-    for i in range(len(parts)):
-        part = pcb.FindFootprintByReference(parts[i])
-        part.SetOrientationDegrees( (part.GetOrientationDegrees() + 180) % 360 )
+        angle = 180
+    for part in gather_footprints(parts):
+        part.SetOrientationDegrees( (part.GetOrientationDegrees() + angle) % 360 )
     Refresh()
     
 def flip_parts(parts, rotate=None):
-    pcb = GetBoard()
+    """
+    Flips parts to the other side of the board, each around its own center
+    parts: List of references, a selector, or a predicate over footprints
+    rotate: Also turns each part by 180 degrees if true
+    """
     if rotate is None:
         rotate = False
-    for i in range(len(parts)):
-        part = pcb.FindFootprintByReference(parts[i])
-        part.Flip(part.GetCenter())
+    for part in gather_footprints(parts):
+        part.Flip(part.GetCenter(), False)
         if rotate:
             part.SetOrientationDegrees( (part.GetOrientationDegrees() + 180) % 360 )
     Refresh()
     
-def place_grid(upper_left=(100.0, 100.0), spacing=(2.54, 2.54), grid_size=(8,8), parts=None, flip_every_second_row=False, rotate_every_second_row=False, default_orientation=0, blank_labels=False, increment_in_columns=False, rotate_grid=None):
+def _mean(values):
+    return sum(values) / float(len(values))
+
+## edge -> (axis, which side of each part's box, how to pick the line from the group)
+alignEdges = {
+    'left':     (0, 'low',    min),
+    'right':    (0, 'high',   max),
+    'top':      (1, 'low',    min),
+    'bottom':   (1, 'high',   max),
+    'center_x': (0, 'center', _mean),
+    'center_y': (1, 'center', _mean),
+}
+
+def _group_geometry(found, by):
+    ## Gathers the group into columns in one pass: positions, then the low and high edges of each part along x and y
+    ## by='position' treats each part as the point at its position, by='box' uses its bounding box without text
+    positions = ([], [])
+    lows = ([], [])
+    highs = ([], [])
+    for part in found:
+        position = part.GetPosition()
+        positions[0].append(position.x)
+        positions[1].append(position.y)
+        if by == 'box':
+            (x0, y0, x1, y1) = _box(part.GetBoundingBox(False, False))
+        else:
+            (x0, y0, x1, y1) = (position.x, position.y, position.x, position.y)
+        lows[0].append(x0)
+        lows[1].append(y0)
+        highs[0].append(x1)
+        highs[1].append(y1)
+    return (positions, lows, highs)
+
+def _edge_values(lows, highs, axis, which):
+    if which == 'low':
+        return lows[axis]
+    if which == 'high':
+        return highs[axis]
+    return [(low + high) / 2.0 for (low, high) in zip(lows[axis], highs[axis])]
+
+def _shifted_plan(found, positions, dxs, dys):
+    ## Every part moved by its own (dx, dy), in board units
+    plan = PlacementPlan()
+    for (part, x, y, dx, dy) in zip(found, positions[0], positions[1], dxs, dys):
+        plan.rows.append((part.GetReference(), int(round(x + dx)), int(round(y + dy)), None, None, None))
+    return plan
+
+def _apply_group(found, positions, axis_deltas, apply, index):
+    ## axis_deltas: (dxs, dys), either may be None for no movement along that axis
+    zeros = [0] * len(found)
+    (dxs, dys) = (zeros if deltas is None else deltas for deltas in axis_deltas)
+    plan = _shifted_plan(found, positions, dxs, dys)
+    if apply:
+        plan.apply(index=index)
+    return plan
+
+def align_parts(parts, edge='left', to=None, apply=True, by='position'):
+    """
+    Lines parts up on a common x or y
+    parts: List of references, a selector, or a predicate over footprints
+    edge: 'left', 'right', 'top', 'bottom' line up on the outermost part, 'center_x', 'center_y' on the average
+    to: Coordinate in mm to line up on instead of working it out from the parts
+    by: 'position' lines up the parts' positions, 'box' their bounding boxes
+    Returns the PlacementPlan
+    """
+    if edge not in alignEdges:
+        print("Unknown edge \"{}\", expecting one of {}".format(edge, ', '.join(sorted(alignEdges))))
+        return
+    (axis, which, pick) = alignEdges[edge]
+    index = footprint_index()
+    found = gather_footprints(parts, index)
+    if len(found) == 0:
+        return PlacementPlan()
+    (positions, lows, highs) = _group_geometry(found, by)
+    values = _edge_values(lows, highs, axis, which)
+    line = pick(values) if to is None else FromMM(to)
+    deltas = [line - value for value in values]
+    return _apply_group(found, positions, (deltas, None) if axis == 0 else (None, deltas), apply, index)
+
+def distribute_parts(parts, axis='x', start=None, end=None, apply=True, mode='pitch', step=None, by='position'):
+    """
+    Spreads parts out evenly along x or y, keeping their order along that axis
+    parts: List of references, a selector, or a predicate over footprints
+    axis: 'x' or 'y'
+    start, end: Where the group starts and ends in mm, defaults to where the outermost parts already are
+    mode: 'pitch' spaces the parts' centers equally, 'gap' leaves equal gaps between their bounding boxes
+    step: Fixed pitch or gap in mm, counted from start, instead of fitting the group between start and end
+    by: 'position' or 'box', what a part's center is in 'pitch' mode; 'gap' mode always uses boxes
+    Returns the PlacementPlan
+    """
+    if axis not in ('x', 'y'):
+        print("Unknown axis \"{}\", expecting either 'x' or 'y'".format(axis))
+        return
+    if mode not in ('pitch', 'gap'):
+        print("Unknown mode \"{}\", expecting either 'pitch' or 'gap'".format(mode))
+        return
+    axis = 0 if axis == 'x' else 1
+    index = footprint_index()
+    found = gather_footprints(parts, index)
+    if len(found) < 2:
+        return PlacementPlan()
+    (positions, lows, highs) = _group_geometry(found, 'box' if mode == 'gap' else by)
+    centers = _edge_values(lows, highs, axis, 'center')
+    order = sorted(range(len(found)), key=lambda i: centers[i])
+    deltas = [0] * len(found)
+    if mode == 'pitch':
+        first = centers[order[0]] if start is None else FromMM(start)
+        if step is not None:
+            pitch = FromMM(step)
+        else:
+            last = centers[order[-1]] if end is None else FromMM(end)
+            pitch = (last - first) / float(len(order) - 1)
+        for (n, i) in enumerate(order):
+            deltas[i] = first + pitch*n - centers[i]
+    else:
+        sizes = [high - low for (low, high) in zip(lows[axis], highs[axis])]
+        cursor = lows[axis][order[0]] if start is None else FromMM(start)
+        if step is not None:
+            gap = FromMM(step)
+        else:
+            last = highs[axis][order[-1]] if end is None else FromMM(end)
+            gap = (last - cursor - sum(sizes)) / float(len(order) - 1)
+        for i in order:
+            deltas[i] = cursor - lows[axis][i]
+            cursor += sizes[i] + gap
+    return _apply_group(found, positions, (deltas, None) if axis == 0 else (None, deltas), apply, index)
+
+def snap_to_grid(parts, grid=1.27, origin=(0.0, 0.0), apply=True, by='position'):
+    """
+    Moves parts onto the nearest grid point
+    parts: List of references, a selector, or a predicate over footprints
+    grid: Grid pitch in mm, either one number or a tuple of (x, y)
+    origin: Tuple of (x, y) mm that the grid is laid out from
+    by: 'position' snaps the parts' positions, 'box' the upper left corner of their bounding boxes
+    Returns the PlacementPlan
+    """
+    if not isinstance(grid, (tuple, list)):
+        grid = (grid, grid)
+    index = footprint_index()
+    found = gather_footprints(parts, index)
+    (positions, lows, highs) = _group_geometry(found, by)
+    deltas = []
+    for axis in (0, 1):
+        (pitch, offset) = (FromMM(grid[axis]), FromMM(origin[axis]))
+        deltas.append([round((value - offset) / float(pitch)) * pitch + offset - value for value in lows[axis]])
+    return _apply_group(found, positions, deltas, apply, index)
+
+def snap_to_pads(parts, target, tolerance=None, apply=True):
+    """
+    Moves each part so its pad nearest to one of target's pads lands right on it, e.g. to stack parts on a shared footprint
+    parts: List of references, a selector, or a predicate over footprints
+    target: Reference of the part whose pads are snapped to
+    tolerance: Parts whose nearest pads are further apart than this many mm are left where they are, None snaps everything
+    Returns the PlacementPlan
+    """
+    index = footprint_index()
+    anchor = _lookup(index, target)
+    if anchor is None:
+        return
+    targets = [tuple(pad.GetPosition()) for pad in anchor.Pads()]
+    found = [part for part in gather_footprints(parts, index) if part.GetReference() != target]
+    (positions, lows, highs) = _group_geometry(found, 'position')
+    limit = None if tolerance is None else FromMM(tolerance)**2
+    deltas = ([], [])
+    for part in found:
+        best = None
+        for pad in part.Pads():
+            (px, py) = pad.GetPosition()
+            for (tx, ty) in targets:
+                distance = (tx - px)**2 + (ty - py)**2
+                if best is None or distance < best[0]:
+                    best = (distance, tx - px, ty - py)
+        if best is None or (limit is not None and best[0] > limit):
+            best = (0, 0, 0)
+        deltas[0].append(best[1])
+        deltas[1].append(best[2])
+    return _apply_group(found, positions, deltas, apply, index)
+
+@memoized_plan
+def plan_grid(upper_left=(100.0, 100.0), spacing=(2.54, 2.54), grid_size=(8,8), parts=None, flip_every_second_row=False, rotate_every_second_row=False, default_orientation=0, blank_labels=False, increment_in_columns=False, rotate_grid=None):
+    parts = plan_references(parts)
     if parts is None:
         print("No components given")
         return
@@ -289,9 +900,8 @@ def place_grid(upper_left=(100.0, 100.0), spacing=(2.54, 2.54), grid_size=(8,8),
     gridRot = 0 if rotate_grid is None else float(rotate_grid) ## What orientation to offset the whole grid (rotating around the upper leftmost centerpoint)
     rad_convert = (math.pi/180) ## Convenience, to make radians from degrees
     
-    pcb = GetBoard()
+    plan = PlacementPlan()
     for i in range(len(parts)):
-        part = pcb.FindFootprintByReference(parts[i]) ## The part, as an object we can manipulate
         if increment_in_columns: ## Is the second part the next row from the first?
             column = int(i/rows)
             row = i%rows
@@ -315,15 +925,396 @@ def place_grid(upper_left=(100.0, 100.0), spacing=(2.54, 2.54), grid_size=(8,8),
         ## then convert back to cartesian to place the component
         xPos = left + (math.cos(result_angle)*dist)
         yPos = top + (math.sin(result_angle)*dist)
-        part.SetPosition(VECTOR2I( FromMM(xPos), FromMM(yPos) ))
         
         ## Rotate the component if requested
-        part.SetOrientationDegrees( ((default_orientation-gridRot) % 360) )
+        orientation = ((default_orientation-gridRot) % 360)
         
         if flip_every_second_row and ( (not increment_in_columns and (row % 2) == 1) or (increment_in_columns and (column % 2) == 1) ):
-            part.SetOrientationDegrees( ((default_orientation-gridRot+180) % 360) );
+            orientation = ((default_orientation-gridRot+180) % 360)
         if rotate_every_second_row and ( (not increment_in_columns and (row % 2) == 1) or (increment_in_columns and (column % 2) == 1) ):
-            part.SetOrientationDegrees( ((default_orientation-gridRot+180) % 360) );
-        if blank_labels:
-            part.Reference().SetVisible(False)
+            orientation = ((default_orientation-gridRot+180) % 360)
+        plan.add(parts[i], xPos, yPos, orientation=orientation, ref_visible=False if blank_labels else None)
+    return plan
+
+def place_grid(upper_left=(100.0, 100.0), spacing=(2.54, 2.54), grid_size=(8,8), parts=None, flip_every_second_row=False, rotate_every_second_row=False, default_orientation=0, blank_labels=False, increment_in_columns=False, rotate_grid=None, apply=True):
+    index = footprint_index() if apply else None
+    plan = plan_grid(upper_left=upper_left, spacing=spacing, grid_size=grid_size, parts=resolve_references(parts, index), flip_every_second_row=flip_every_second_row, rotate_every_second_row=rotate_every_second_row, default_orientation=default_orientation, blank_labels=blank_labels, increment_in_columns=increment_in_columns, rotate_grid=rotate_grid)
+    if apply and plan is not None:
+        plan.apply(index=index)
+    return plan
+
+def split_reference(reference):
+    """
+    Splits a reference into its prefix and number, ('D', 12) for D12, (reference, None) if there's no number
+    """
+    match = re.match(r'^(.*?)(\d+)$', reference)
+    if match is None:
+        return (reference, None)
+    return (match.group(1), int(match.group(2)))
+
+def offset_reference(reference, offset):
+    """
+    Shifts the number of a reference, D12 offset by 20 is D32
+    offset: Either a number, or a dict of prefix -> number to shift each prefix differently
+    """
+    prefix, number = split_reference(reference)
+    if isinstance(offset, dict):
+        offset = offset.get(prefix)
+    if number is None or offset is None:
+        return None
+    return '{}{}'.format(prefix, number+offset)
+
+def _rotate_offset(x, y, angle):
+    ## Rotates a board offset the same way KiCad turns a footprint (y points down, positive is CCW on screen)
+    rad = math.radians(angle)
+    return (x*math.cos(rad) + y*math.sin(rad), -x*math.sin(rad) + y*math.cos(rad))
+
+def _split_path(part):
+    ## Repeated hierarchical sheets share symbol UUIDs, only the sheet part of the path differs
+    (sheet, sep, symbol) = part.GetPath().AsString().rpartition('/')
+    return (sheet, symbol)
+
+def _report_unoffset(reference, offset):
+    (prefix, number) = split_reference(reference)
+    if number is None:
+        print("{} has no number to offset, skipping it".format(reference))
+    else:
+        print("No offset for prefix \"{}\" in {}, skipping {}".format(prefix, offset, reference))
+
+def replicate_layout(anchor, source, channels, match='offset', step=None, rotation_step=None, rotation_center=None, refresh=True):
+    """
+    Copies the arrangement of an already placed block of parts onto other channels
+    anchor: Reference of the part in the block that the arrangement is measured from
+    source: List of references (or a selector) of the placed block, the anchor is always included
+    channels: One entry per copy, depends on match
+      match='offset': Reference number offsets, either a number or a dict of prefix -> number (e.g. {'D': 20, 'C': 5})
+      match='sheet': References (or a selector) of the anchor part in each copy of the hierarchical sheet
+    match: How the parts of each channel are found, 'offset' or 'sheet'
+    step: Tuple of (x, y) mm between copies, the nth channel's anchor is placed n steps from the source anchor
+    rotation_step: Degrees between copies, the nth channel's anchor is turned n steps around rotation_center
+    rotation_center: Tuple of (x, y) mm to turn copies around, defaults to the source anchor
+    If neither step nor rotation_step is given, each channel's anchor stays where it is and the rest of the channel follows it
+    Returns the PlacementPlan that was applied
+    """
+    if match not in ('offset', 'sheet'):
+        print("Unknown match \"{}\", expecting either 'offset' or 'sheet'".format(match))
+        return
+    index = footprint_index()
+    source = resolve_references(source, index)
+    if anchor not in source:
+        source.append(anchor)
+    if match == 'sheet':
+        channels = resolve_references(channels, index)
+        by_path = dict((_split_path(part), part) for part in index.values())
+    anchor_part = _lookup(index, anchor)
+    if anchor_part is None:
+        return
+    (ax, ay) = anchor_part.GetPosition()
+    anchor_angle = anchor_part.GetOrientationDegrees()
+
+    ## Each part's place relative to the anchor, worked out once and reused for every channel
+    relative = []
+    for reference in source:
+        part = _lookup(index, reference)
+        if part is None:
+            continue
+        (x, y) = part.GetPosition()
+        (lx, ly) = _rotate_offset(x-ax, y-ay, -anchor_angle)
+        relative.append((reference, part, lx, ly, part.GetOrientationDegrees()-anchor_angle, part.IsFlipped()))
+
+    if rotation_center is None:
+        (cx, cy) = (ax, ay)
+    else:
+        (cx, cy) = (FromMM(rotation_center[0]), FromMM(rotation_center[1]))
+    plan = PlacementPlan()
+    for n, channel in enumerate(channels, start=1):
+        if match == 'offset':
+            target_anchor = offset_reference(anchor, channel)
+            if target_anchor is None:
+                _report_unoffset(anchor, channel)
+                continue
+        else:
+            target_anchor = channel
+        if step is None and rotation_step is None:
+            target = _lookup(index, target_anchor)
+            if target is None:
+                continue
+            (tx, ty) = target.GetPosition()
+            target_angle = target.GetOrientationDegrees()
+        else:
+            turn = 0 if rotation_step is None else rotation_step*n
+            (tx, ty) = _rotate_offset(ax-cx, ay-cy, turn)
+            (tx, ty) = (cx+tx, cy+ty)
+            if step is not None:
+                (tx, ty) = (tx+FromMM(step[0]*n), ty+FromMM(step[1]*n))
+            target_angle = anchor_angle+turn
+        if match == 'sheet':
+            target = _lookup(index, target_anchor)
+            if target is None:
+                continue
+            sheet = _split_path(target)[0]
+        for (reference, part, lx, ly, angle, flipped) in relative:
+            if match == 'offset':
+                target_reference = offset_reference(reference, channel)
+                if target_reference is None:
+                    _report_unoffset(reference, channel)
+                    continue
+                part = _lookup(index, target_reference)
+            else:
+                part = by_path.get((sheet, _split_path(part)[1]))
+                if part is None:
+                    print("Couldn't find the copy of {} in sheet {}, skipping it".format(reference, sheet))
+            if part is None:
+                continue
+            (dx, dy) = _rotate_offset(lx, ly, target_angle)
+            plan.rows.append((part.GetReference(), int(round(tx+dx)), int(round(ty+dy)), (target_angle+angle) % 360, 'back' if flipped else 'front', None))
+    plan.apply(index=index, refresh=refresh)
+    return plan
+
+def boxes_overlap(a, b):
+    """
+    True if two (x0, y0, x1, y1) boxes overlap, boxes that only touch don't count
+    """
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+def _box(bbox):
+    return (bbox.GetLeft(), bbox.GetTop(), bbox.GetRight(), bbox.GetBottom())
+
+## Cell size in mm for spatial hashes over parts, about the size of a small part
+hashCellSize = 2.0
+
+class SpatialHash(object):
+    """
+    Buckets (x0, y0, x1, y1) boxes into square cells so the boxes near a spot can be found without checking every box
+    cell_size: Cell edge in board units, about the size of a typical box works best
+    """
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.cells = {}
+
+    def _cells(self, box):
+        size = self.cell_size
+        for cx in range(int(math.floor(box[0]/size)), int(math.floor(box[2]/size))+1):
+            for cy in range(int(math.floor(box[1]/size)), int(math.floor(box[3]/size))+1):
+                yield (cx, cy)
+
+    def insert(self, box, item=None):
+        entry = (box, item)
+        for cell in self._cells(box):
+            self.cells.setdefault(cell, []).append(entry)
+
+    def overlapping(self, box):
+        """
+        Returns the (box, item) entries that overlap box
+        """
+        seen = set()
+        found = []
+        for cell in self._cells(box):
+            for entry in self.cells.get(cell, ()):
+                if id(entry) in seen:
+                    continue
+                seen.add(id(entry))
+                if boxes_overlap(box, entry[0]):
+                    found.append(entry)
+        return found
+
+def load_rotation_offsets(path):
+    """
+    Reads a rotation offset table, one "footprint name glob,degrees" row per line; anything else (headers, comments) is skipped
+    """
+    offsets = []
+    with open(path) as f:
+        for row in csv.reader(f):
+            if len(row) < 2:
+                continue
+            try:
+                offsets.append((row[0].strip(), float(row[1])))
+            except ValueError:
+                continue
+    return offsets
+
+def _position_rows(source, pcb):
+    ## Yields (footprint, x, y, orientation, side) without building a list, from the plan if there is one, the board if not
+    if source is None:
+        for part in pcb.GetFootprints():
+            position = part.GetPosition()
+            yield (part, position.x, position.y, part.GetOrientationDegrees(), _side(part))
+        return
+    index = footprint_index(pcb)
+    for (reference, x, y, orientation, side, ref_visible) in source:
+        part = _lookup(index, reference)
+        if part is None:
+            continue
+        yield (part, x, y, part.GetOrientationDegrees() if orientation is None else orientation, _side(part) if side is None else side)
+
+def _planned_box(part, x, y, orientation, side):
+    ## The footprint's outline as it would be where the plan puts it: flipped and turned to match, then moved
+    position = part.GetPosition()
+    current = part.GetOrientationDegrees()
+    (x0, y0, x1, y1) = _box(part.GetBoundingBox(False, False))
+    corners = [(cx - position.x, cy - position.y) for cx in (x0, x1) for cy in (y0, y1)]
+    if side != _side(part):
+        ## Flipping top to bottom mirrors the outline across x and negates the orientation
+        corners = [(cx, -cy) for (cx, cy) in corners]
+        current = -current
+    turn = orientation - current
+    if not _same_angle(turn, 0):
+        corners = [_rotate_offset(cx, cy, turn) for (cx, cy) in corners]
+    xs = [x + cx for (cx, cy) in corners]
+    ys = [y + cy for (cx, cy) in corners]
+    return (min(xs), min(ys), max(xs), max(ys))
+
+positionColumns = ['Ref', 'Val', 'Package', 'PosX', 'PosY', 'Rot', 'Side']
+
+def export_positions(path, source=None, format=None, rotation_offsets=None, origin=(0.0, 0.0), summary_path=None, pcb=None):
+    """
+    Writes a pick-and-place file, one row at a time, for the parts a helper placed or for the whole board
+    path: File to write
+    source: A PlacementPlan, e.g. what a place_* helper returned, or None for every footprint on the board
+    format: 'csv' or 'json', taken from path's extension if None
+    rotation_offsets: Degrees added to the rotation by footprint name, either a list of (glob, degrees) or a dict, first match wins,
+                      or the path of a CSV table for load_rotation_offsets
+    origin: Tuple of (x, y) mm that positions are measured from, y points up as in KiCad's own position files
+    summary_path: Also writes a JSON summary here with the parts written, their bounding box and how many overlap
+    pcb: Board the parts are on, defaults to the open board
+    Returns the summary
+    """
+    if format is None:
+        format = 'json' if path.lower().endswith('.json') else 'csv'
+    if format not in ('csv', 'json'):
+        print("Unknown format \"{}\", expecting either 'csv' or 'json'".format(format))
+        return
+    if pcb is None:
+        pcb = GetBoard()
+    if isinstance(rotation_offsets, str):
+        rotation_offsets = load_rotation_offsets(rotation_offsets)
+    elif isinstance(rotation_offsets, dict):
+        rotation_offsets = list(rotation_offsets.items())
+    ## Packages repeat a lot, so each one's offset is only looked up once
+    package_offsets = {}
+    (ox, oy) = (FromMM(origin[0]), FromMM(origin[1]))
+
+    written = 0
+    overlaps = 0
+    (minx, miny, maxx, maxy) = (None, None, None, None)
+    boxes = SpatialHash(FromMM(hashCellSize))
+    with open(path, 'w', newline='') as f:
+        if format == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(positionColumns)
+        else:
+            f.write('[')
+        for (part, x, y, orientation, side) in _position_rows(source, pcb):
+            if part.GetAttributes() & FP_EXCLUDE_FROM_POS_FILES:
+                continue
+            package = str(part.GetFPID().GetLibItemName())
+            if package not in package_offsets:
+                package_offsets[package] = 0.0
+                for (pattern, offset) in (rotation_offsets or ()):
+                    if fnmatch.fnmatchcase(package, pattern):
+                        package_offsets[package] = float(offset)
+                        break
+            row = [part.GetReference(), part.GetValue(), package,
+                   round(ToMM(x - ox), 4), round(ToMM(oy - y), 4),
+                   round((orientation + package_offsets[package]) % 360, 4), 'top' if side == 'front' else 'bottom']
+            if format == 'csv':
+                writer.writerow(row[:3] + ['{:.4f}'.format(v) for v in row[3:6]] + row[6:])
+            else:
+                f.write((',\n' if written > 0 else '\n') + json.dumps(dict(zip(positionColumns, row))))
+            written += 1
+
+            box = _planned_box(part, x, y, orientation, side)
+            overlaps += sum(1 for (other, other_side) in boxes.overlapping(box) if other_side == side)
+            boxes.insert(box, side)
+            if minx is None:
+                (minx, miny, maxx, maxy) = box
+            else:
+                (minx, miny, maxx, maxy) = (min(minx, box[0]), min(miny, box[1]), max(maxx, box[2]), max(maxy, box[3]))
+        if format == 'json':
+            f.write('\n]\n')
+
+    summary = {
+        'file': path,
+        'parts': written,
+        'bounding_box': None if minx is None else [ToMM(minx), ToMM(miny), ToMM(maxx), ToMM(maxy)],
+        'overlaps': overlaps,
+    }
+    print('Wrote {} parts to {}, {} overlapping pairs'.format(written, path, overlaps))
+    if summary_path is not None:
+        with open(summary_path, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+## Spots place_labels tries, in order, for the center of each label
+## (0, 0) is the middle of the footprint, (0, -1) just above it, (1, 0) just right of it, and so on
+labelCandidates = [(0, -1), (0, 1), (-1, 0), (1, 0), (-1, -1), (1, -1), (-1, 1), (1, 1), (0, 0)]
+
+def place_labels(parts=None, candidates=None, clearance=0.2, hide_unplaced=True, show_hidden=False):
+    """
+    Moves reference labels next to their footprints so they don't overlap pads or each other
+    parts: List of references, a selector, or a predicate over footprints; every footprint on the board if None
+    candidates: List of (x, y) spots to try for each label, see labelCandidates
+    clearance: Gap in mm kept around each label
+    hide_unplaced: Hides labels that have nowhere to go if true, leaves them where they were if false
+    show_hidden: Also places labels that are currently hidden if true, they're left alone if false
+    Returns (labels placed, labels hidden)
+    """
+    if candidates is None:
+        candidates = labelCandidates
+    gap = FromMM(clearance)
+    index = footprint_index()
+    if parts is None:
+        found = [index[reference] for reference in sorted(index, key=natural_key)]
+    else:
+        found = gather_footprints(parts, index)
+    placing = set(part.GetReference() for part in found)
+
+    ## Pads never move, and labels outside the set stay where they are, so both are obstacles from the start
+    obstacles = {'front': SpatialHash(FromMM(hashCellSize)), 'back': SpatialHash(FromMM(hashCellSize))}
+    for part in index.values():
+        for pad in part.Pads():
+            box = _box(pad.GetBoundingBox())
+            if pad.IsOnLayer(F_Cu):
+                obstacles['front'].insert(box)
+            if pad.IsOnLayer(B_Cu):
+                obstacles['back'].insert(box)
+        if part.GetReference() not in placing and part.Reference().IsVisible():
+            obstacles[_side(part)].insert(_box(part.Reference().GetBoundingBox()))
+
+    placed = 0
+    hidden = 0
+    for part in found:
+        label = part.Reference()
+        if not label.IsVisible() and not show_hidden:
+            continue
+        (lx0, ly0, lx1, ly1) = _box(label.GetBoundingBox())
+        (half_w, half_h) = ((lx1 - lx0) / 2.0, (ly1 - ly0) / 2.0)
+        (fx0, fy0, fx1, fy1) = _box(part.GetBoundingBox(False, False))
+        (fcx, fcy) = ((fx0 + fx1) / 2.0, (fy0 + fy1) / 2.0)
+        reach_x = (fx1 - fx0) / 2.0 + half_w + gap
+        reach_y = (fy1 - fy0) / 2.0 + half_h + gap
+        side = obstacles[_side(part)]
+        spot = None
+        for (cx, cy) in candidates:
+            (x, y) = (fcx + cx*reach_x, fcy + cy*reach_y)
+            box = (x - half_w - gap, y - half_h - gap, x + half_w + gap, y + half_h + gap)
+            if len(side.overlapping(box)) == 0:
+                spot = (x, y)
+                break
+        if spot is None:
+            if hide_unplaced:
+                label.SetVisible(False)
+                hidden += 1
+            else:
+                ## Left visible where it was, so later labels have to keep clear of it
+                side.insert((lx0, ly0, lx1, ly1))
+            continue
+        ## Labels are moved by their box center, whatever their justification
+        position = label.GetPosition()
+        label.SetPosition(VECTOR2I(int(round(position.x + spot[0] - (lx0 + lx1) / 2.0)), int(round(position.y + spot[1] - (ly0 + ly1) / 2.0))))
+        label.SetVisible(True)
+        side.insert((spot[0] - half_w, spot[1] - half_h, spot[0] + half_w, spot[1] + half_h))
+        placed += 1
+    print('Placed {} labels, hid {}'.format(placed, hidden))
     Refresh()
+    return (placed, hidden)